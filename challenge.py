@@ -1,4 +1,5 @@
 from rag_engine import HebrewRAGEngine
+import asyncio
 import os
 
 def run_challenge():
@@ -14,7 +15,7 @@ def run_challenge():
     print(f"\n--- Challenge Query: '{query}' ---")
     
     # Use the full search (including LLM if key is there, but focusing on retrieval)
-    response = engine.search(query, top_k=7)
+    response = asyncio.run(engine.search(query, top_k=7))
     
     print("\n[LLM Answer]")
     print(response.answer)
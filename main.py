@@ -1,9 +1,12 @@
-from fastapi import FastAPI, HTTPException, Body
-from typing import List, Optional, Dict, Any
+from fastapi import FastAPI, HTTPException, Body, BackgroundTasks
+from typing import List, Optional, Any
 from pydantic import BaseModel
 import os
+import time
 import uuid
-from rag_engine import HebrewRAGEngine, RetrievedChunk, RAGSearchResponse
+import aiosqlite
+from contextlib import asynccontextmanager
+from rag_engine import HebrewRAGEngine, QueryBatcher, RetrievedChunk, RAGSearchResponse
 
 # --- Pydantic Models from Spec ---
 
@@ -48,7 +51,29 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 
-app = FastAPI(title="Hebrew RAG API", description="Comprehensive RAG API for Hebrew Documents")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global engine, query_batcher, sessions_db
+    # Built here rather than at import: spawned parser workers re-import the
+    # __main__ module, and must not load the model or the index again
+    engine = HebrewRAGEngine()
+    # Load existing index if available
+    if os.path.exists("hebrew_rag_index.index"):
+        engine.load_index("hebrew_rag_index")
+    query_batcher = QueryBatcher(engine)
+    sessions_db = await aiosqlite.connect(SESSIONS_DB)
+    await sessions_db.execute(
+        "CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL, ts INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL)"
+    )
+    await sessions_db.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id)")
+    await sessions_db.commit()
+    # Coalesces concurrent /search and /chat queries into batched FAISS calls
+    query_batcher.start()
+    yield
+    await query_batcher.stop()
+    await sessions_db.close()
+
+app = FastAPI(title="Hebrew RAG API", description="Comprehensive RAG API for Hebrew Documents", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -67,41 +92,61 @@ async def serve_frontend():
 # Also mount the current directory to serve script.js and style.css
 # We do this at the end to not shadow other routes
 
-# Global engine instance
-engine = HebrewRAGEngine()
-# Load existing index if available
-if os.path.exists("hebrew_rag_index.index"):
-    engine.load_index("hebrew_rag_index")
-
-# In-memory session store for chat (In production, use MongoDB as per spec)
-sessions: Dict[str, List[dict]] = {}
+# Global engine instance, created in lifespan
+engine: Optional[HebrewRAGEngine] = None
+query_batcher: Optional[QueryBatcher] = None
+
+# Chat history lives in SQLite so it survives restarts and doesn't grow RAM
+SESSIONS_DB = "sessions.db"
+# Most recent messages returned in ChatResponse.history
+HISTORY_TAIL = 100
+sessions_db: Optional[aiosqlite.Connection] = None
+
+async def append_messages(session_id: str, messages: List[dict]):
+    ts = time.time_ns()
+    await sessions_db.executemany(
+        "INSERT INTO messages (session_id, ts, role, content) VALUES (?, ?, ?, ?)",
+        [(session_id, ts, m["role"], m["content"]) for m in messages]
+    )
+    await sessions_db.commit()
+
+async def get_history(session_id: str, limit: int = HISTORY_TAIL) -> List[dict]:
+    async with sessions_db.execute(
+        "SELECT role, content FROM messages WHERE session_id = ? ORDER BY rowid DESC LIMIT ?",
+        (session_id, limit)
+    ) as cursor:
+        rows = await cursor.fetchall()
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
 
 from fastapi import FastAPI, HTTPException, Body, File, UploadFile
 import shutil
 
 @app.post("/upload", response_model=UploadResponse)
-async def upload_document(request: UploadRequest):
+async def upload_document(request: UploadRequest, background_tasks: BackgroundTasks):
     """
     Uploads raw text content to the RAG system using the engine's processing logic.
+    Embedding and indexing run in the background; the response returns immediately
+    with status "pending".
     """
     try:
         doc_id = request.metadata.doc_id if request.metadata else str(uuid.uuid4())
         
-        # Determine number of chunks before adding
-        # (This is just for the response, since add_text handles the logic)
-        temp_chunks = engine.chunk_content(request.content, request.chunk_size, request.chunk_overlap)
-        
-        engine.add_text(
+        # Chunk once: the count goes in the response and the same chunks are
+        # indexed in the background. API text is already in logical order.
+        _, chunks, metas = engine.prepare_chunks(
             text=request.content,
             doc_id=doc_id,
             metadata=request.metadata.dict() if request.metadata else None,
             chunk_size=request.chunk_size,
-            overlap=request.chunk_overlap
+            overlap=request.chunk_overlap,
+            fix_text=False
         )
         
+        background_tasks.add_task(engine.index_chunks, chunks, metas)
+        
         return UploadResponse(
-            status="success",
-            total_chunks=len(temp_chunks),
+            status="pending",
+            total_chunks=len(chunks),
             doc_id=doc_id
         )
     except Exception as e:
@@ -138,7 +183,7 @@ async def search(request: RAGSearchRequest):
     Performs a single-turn RAG search.
     """
     try:
-        results = engine.search(request.query, top_k=request.top_k)
+        results = await query_batcher.search(request.query, top_k=request.top_k)
         if not request.include_sources:
             results.sources = []
         return results
@@ -153,19 +198,16 @@ async def chat(request: ChatRequest):
     try:
         session_id = request.session_id or str(uuid.uuid4())
         
-        if session_id not in sessions:
-            sessions[session_id] = []
-            
-        # Get history
-        history = sessions[session_id]
-        
         # For RAG with history, we usually embed the query or a reformulated one.
         # Simple approach: Search based on current message.
-        results = engine.search(request.message, top_k=request.top_k)
+        results = await query_batcher.search(request.message, top_k=request.top_k)
         
         # Add to history
-        history.append({"role": "user", "content": request.message})
-        history.append({"role": "assistant", "content": results.answer})
+        await append_messages(session_id, [
+            {"role": "user", "content": request.message},
+            {"role": "assistant", "content": results.answer}
+        ])
+        history = await get_history(session_id)
         
         return ChatResponse(
             session_id=session_id,
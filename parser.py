@@ -1,16 +1,20 @@
+import os
+import multiprocessing
 import pdfplumber
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
 import re
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Any
 
-class HebrewPDFParser:
-    def __init__(self):
-        # Hebrew character range
-        self.hebrew_pattern = re.compile(r'[\u0590-\u05FF]')
+# Hebrew character range; bound search method, hoisted out of the per-line loop
+_HEBREW_RE = re.compile(r'[\u0590-\u05FF]').search
 
+class HebrewPDFParser:
     def is_hebrew(self, text: str) -> bool:
         if not text:
             return False
-        return bool(self.hebrew_pattern.search(text))
+        return bool(_HEBREW_RE(text))
 
     def fix_hebrew_text(self, text: str) -> str:
         """
@@ -21,23 +25,25 @@ class HebrewPDFParser:
         if not text:
             return ""
         
-        # Split into lines and process each
-        lines = text.split('\n')
-        fixed_lines = []
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Check if majority is Hebrew or contains Hebrew
-            if self.is_hebrew(line):
-                # Reverse the whole line (Visual -> Logical)
-                fixed_lines.append(line[::-1])
-            else:
-                fixed_lines.append(line)
+        # Reverse Hebrew lines (Visual -> Logical) in one pass
+        hsearch = _HEBREW_RE
+        fixed_lines = [
+            line[::-1] if hsearch(line) else line
+            for line in (raw.strip() for raw in text.split('\n'))
+            if line
+        ]
         
         return "\n".join(fixed_lines)
 
+    def clean_text(self, text: str) -> str:
+        """
+        Normalizes text that is already in logical order: strips lines and
+        drops empty ones, without reversing.
+        """
+        if not text:
+            return ""
+        return "\n".join(line for line in (raw.strip() for raw in text.splitlines()) if line)
+
     def table_to_markdown(self, table: List[List[str]]) -> str:
         if not table:
             return ""
@@ -64,35 +70,65 @@ class HebrewPDFParser:
         
         return "\n".join(rows)
 
-    def extract_content(self, pdf_path: str) -> List[Dict[str, Any]]:
+    def extract_page(self, pdf_path: str, page_num: int) -> List[Dict[str, Any]]:
         results = []
-        print(f"Loading {pdf_path}...")
-        with pdfplumber.open(pdf_path) as pdf:
-            for page_num, page in enumerate(pdf.pages):
-                # We do NOT use layout=True as it fragments text too much
-                # Instead, we extract directly and handle the reversal
-                text = page.extract_text()
-                
-                if text:
-                    fixed_text = self.fix_hebrew_text(text)
-                    results.append({
-                        "page": page_num + 1,
-                        "type": "text",
-                        "content": fixed_text
-                    })
-                
-                # Extract tables
-                tables = page.extract_tables()
-                for i, table in enumerate(tables):
-                    md_table = self.table_to_markdown(table)
-                    results.append({
-                        "page": page_num + 1,
-                        "type": "table",
-                        "content": md_table
-                    })
-                    
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            page = pdf[page_num]
+            # PDFium (C++) is far faster than pdfminer and returns Hebrew in
+            # logical order already, so only whitespace cleanup is needed
+            text = self.clean_text(page.get_textpage().get_text_range())
+            has_paths = next(page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_PATH]), None) is not None
+        finally:
+            pdf.close()
+        
+        if text:
+            results.append({
+                "page": page_num + 1,
+                "type": "text",
+                "content": text
+            })
+        
+        # Extract tables. pdfplumber's line-based table finder needs ruling
+        # lines, so pages without vector paths are skipped.
+        if has_paths:
+            with pdfplumber.open(pdf_path, pages=[page_num + 1]) as plumber_pdf:
+                tables = plumber_pdf.pages[0].extract_tables()
+            for i, table in enumerate(tables):
+                md_table = self.table_to_markdown(table)
+                results.append({
+                    "page": page_num + 1,
+                    "type": "table",
+                    "content": md_table
+                })
+        
         return results
 
+    def extract_content(self, pdf_path: str, max_workers: int = None) -> List[Dict[str, Any]]:
+        print(f"Loading {pdf_path}...")
+        pdf = pdfium.PdfDocument(pdf_path)
+        num_pages = len(pdf)
+        pdf.close()
+        
+        # Pages are independent, so parse them in worker processes
+        # (pdfminer is pure Python and holds the GIL, and PDFium is not thread-safe)
+        max_workers = min(max_workers or os.cpu_count() or 1, num_pages)
+        if max_workers <= 1:
+            page_results = [self.extract_page(pdf_path, n) for n in range(num_pages)]
+        else:
+            # spawn, not fork: uploads run on server threads, and forking a
+            # threaded process can deadlock the child on a copied lock
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+                page_results = executor.map(_process_page, [pdf_path] * num_pages, range(num_pages))
+                page_results = list(page_results)
+        
+        return [item for items in page_results for item in items]
+
+def _process_page(pdf_path: str, page_num: int) -> List[Dict[str, Any]]:
+    # Top-level so it can be pickled for ProcessPoolExecutor
+    return HebrewPDFParser().extract_page(pdf_path, page_num)
+
 if __name__ == "__main__":
     parser = HebrewPDFParser()
     test_file = "1169_2011_food_information_HE.pdf"
@@ -1,8 +1,18 @@
 import os
+import asyncio
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import pathlib
 import faiss
 import numpy as np
 import pickle
-from typing import List, Dict, Any, Optional
+import sqlite3
+import threading
+import torch
+from typing import List, Dict, Any, Iterable, Iterator, Optional
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 import google.generativeai as genai
@@ -24,23 +34,204 @@ class RetrievedChunk(BaseModel):
     chunk_id: str
     doc_id: str
     text: str
-    score: float
+    score: float  # cosine similarity in [-1, 1], higher is better
     metadata: Optional[dict] = None
 
 class RAGSearchResponse(BaseModel):
     answer: str
     sources: List[RetrievedChunk]
 
+# --- LLM Prompt ---
+
+# Static instructions, kept separate from the per-call context/question so
+# providers can cache the prefix instead of re-prefilling it every call.
+SYSTEM_PROMPT = """
+### 🧠 הוראות למערכת ה-RAG
+אתה מומחה לניתוח מסמכים רגולטוריים ומשפטיים. תפקידך לספק תשובה **מקיפה, מדויקת ומובנית** בעברית, המבוססת אך ורק על הקונטקסט המצורף למטה.
+
+### � כללי עבודה מחייבים:
+1.  **היצמדות לקונטקסט**: ענה אך ורק על סמך המידע הניתון. אל תשתמש בידע קודם.
+2.  **מקיפות**: אם המידע מופיע במספר מקומות בקונטקסט, שלב את כולם לתשובה אחת שלמה.
+3.  **מבנה**: השתמש בנקודות (bullet points) או במספור במידה ויש רשימת תנאים או דרישות.
+4.  **חוסר מידע**: אם הקונטקסט אינו מכיל מספיק מידע כדי לענות על השאלה במלואה, ציין זאת במפורש. השב: "המידע אינו מופיע במסמכים שנסרקו".
+5.  **דיוק לשוני**: השתמש בשפה מקצועית ועניינית התואמת את אופי המסמכים (חקיקה, רגולציה).
+
+### 📄 ציון מקורות (חובה):
+בסוף התשובה, הוסף פסקה בשם "מקורות:" ופרט את מספרי העמודים והמסמכים עליהם התבססת.
+דוגמה: *מקורות: עמודים 14, 15 (מתוך food_regulation).*
+"""
+
+# --- Chunk Metadata Store ---
+
+class MetaStore:
+    """
+    Chunk metadata in an SQLite table keyed by FAISS row id. Rows live in a
+    private temporary db that SQLite spills to disk, so RAM doesn't grow with
+    the corpus. A saved store is copied in by load and only written back by
+    save, so it always matches the saved index. Rows are returned as dicts in
+    the shape the engine always used.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chunks (
+            id INTEGER PRIMARY KEY,
+            doc_id TEXT NOT NULL,
+            page INTEGER,
+            type TEXT NOT NULL,
+            text TEXT NOT NULL,
+            metadata TEXT
+        )
+    """
+
+    def __init__(self):
+        # Written from background upload threads, read from the event loop
+        self._lock = threading.Lock()
+        # "" is a private on-disk temp db, deleted when the connection closes
+        self._conn = sqlite3.connect("", check_same_thread=False)
+        self._conn.execute(self.SCHEMA)
+        self._size = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, idx: int) -> dict:
+        rows = self.get_many([idx])
+        if not rows:
+            raise IndexError(idx)
+        return rows[0]
+
+    def get_many(self, ids: List[int]) -> List[dict]:
+        """Fetches rows in the order given, skipping unknown ids."""
+        if not ids:
+            return []
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, doc_id, page, type, text, metadata FROM chunks WHERE id IN ({placeholders})",
+                [int(i) for i in ids],
+            ).fetchall()
+        by_id = {row[0]: self._row_to_meta(row) for row in rows}
+        return [by_id[i] for i in ids if i in by_id]
+
+    def extend(self, metas: List[dict]):
+        # Ids continue from the current size, matching FAISS's sequential ids
+        with self._lock:
+            try:
+                self._conn.executemany(
+                    "INSERT INTO chunks (id, doc_id, page, type, text, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+                    (self._meta_to_row(self._size + i, m) for i, m in enumerate(metas)),
+                )
+                self._conn.commit()
+            except Exception:
+                # Drop a partial insert so ids stay in step with the index
+                self._conn.rollback()
+                raise
+            self._size += len(metas)
+
+    def truncate(self, size: int):
+        """Drops rows with id >= size."""
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks WHERE id >= ?", (size,))
+            self._conn.commit()
+            self._size = min(self._size, size)
+
+    def save(self, db_path: str):
+        # Back up to a temp file and swap it in, so readers never see a
+        # half-written store
+        with self._lock:
+            dest = sqlite3.connect(f"{db_path}.tmp")
+            try:
+                self._conn.backup(dest)
+            finally:
+                dest.close()
+        os.replace(f"{db_path}.tmp", db_path)
+
+    @classmethod
+    def load(cls, db_path: str) -> "MetaStore":
+        """Copies a saved store into a new private one; db_path is only read."""
+        store = cls()
+        src = sqlite3.connect(f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            src.backup(store._conn)
+        finally:
+            src.close()
+        store._size = store._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        return store
+
+    @classmethod
+    def from_legacy_pickle(cls, pickle_path: str, db_path: str) -> "MetaStore":
+        # Older indexes stored metadata as a pickled list of per-chunk dicts,
+        # or as parallel arrays; migrate them once into the SQLite file
+        with open(pickle_path, "rb") as f:
+            state = pickle.load(f)
+        if isinstance(state, dict):
+            state = [
+                {"doc_id": doc_id, "page": int(page), "type": ["text", "table"][t], "text": text,
+                 **({"metadata": extra} if extra is not None else {})}
+                for doc_id, page, t, text, extra in zip(
+                    state["doc_ids"], state["pages"], state["types"], state["texts"], state["extras"]
+                )
+            ]
+        store = cls()
+        store.extend(state)
+        store.save(db_path)
+        return store
+
+    @staticmethod
+    def _meta_to_row(idx: int, meta: dict) -> tuple:
+        extra = meta.get("metadata")
+        return (idx, meta["doc_id"], meta["page"], meta["type"], meta["text"],
+                json.dumps(extra, ensure_ascii=False) if extra is not None else None)
+
+    @staticmethod
+    def _row_to_meta(row: tuple) -> dict:
+        _, doc_id, page, content_type, text, extra = row
+        meta = {"doc_id": doc_id, "page": page, "type": content_type, "text": text}
+        if extra is not None:
+            meta["metadata"] = json.loads(extra)
+        return meta
+
 # --- RAG Engine Class ---
 
 class HebrewRAGEngine:
-    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2'):
+    # HNSW graph parameters (neighbors per node, build/search beam widths)
+    HNSW_M = 32
+    HNSW_EF_CONSTRUCTION = 200
+    HNSW_EF_SEARCH = 64
+    # Vectors buffered exactly before the 8-bit quantizer is trained on them
+    SQ_TRAIN_SIZE = 10000
+    EMBED_BATCH_SIZE = 64
+    # Chunks embedded and added per window, bounding peak memory
+    INDEX_BATCH_SIZE = 256
+    # Chunk embeddings kept for re-uploads, least recently used evicted
+    EMB_CACHE_SIZE = 8192
+    # Semantic query cache: reuse a response when a previous query is this similar
+    QUERY_CACHE_THRESHOLD = 0.97
+    QUERY_CACHE_SIZE = 1024
+
+    # Pre-exported dynamic int8 ONNX weights shipped in the model repo
+    ONNX_INT8_FILE = 'onnx/model_quint8_avx2.onnx'
+
+    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2', index_type='hnsw',
+                 embedding_backend='torch'):
         print(f"Loading embedding model: {model_name}...")
-        self.embedding_model = SentenceTransformer(model_name)
+        self.embedding_model = self._load_embedding_model(model_name, embedding_backend)
         self.dimension = self.embedding_model.get_sentence_embedding_dimension()
-        self.index = faiss.IndexFlatL2(self.dimension)
-        self.metadata_store = []
+        self.index_type = index_type
+        self.index = self._create_index()
+        # True while the index is a read-only mmap of the file on disk
+        self._index_mmapped = False
+        self.metadata_store = MetaStore()
+        # Uploads are indexed from background threads while searches run
+        self._index_lock = threading.Lock()
+        # sha256(chunk text) -> embedding, so repeated chunks skip the model
+        self._emb_cache: collections.OrderedDict[bytes, np.ndarray] = collections.OrderedDict()
+        self._emb_lock = threading.Lock()
         self.parser = HebrewPDFParser()
+        # The query cache is cleared from upload threads and used from the
+        # event loop; the generation counter is bumped on every clear
+        self._qcache_lock = threading.Lock()
+        self.query_cache_generation = 0
+        self._clear_query_cache()
         
         # Configure LLM (Gemini with Groq fallback)
         self.llm_provider = None
@@ -51,20 +242,22 @@ class HebrewRAGEngine:
         
         if google_key:
             genai.configure(api_key=google_key)
-            self.llm_client = genai.GenerativeModel('gemini-1.5-flash')
+            # The static instructions go in system_instruction, so each call
+            # only carries the retrieved context and the question
+            self.llm_client = genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_PROMPT)
             self.llm_provider = "google"
             self.groq_fallback_client = None
             if groq_key:
                 try:
-                    from groq import Groq
-                    self.groq_fallback_client = Groq(api_key=groq_key)
+                    from groq import AsyncGroq
+                    self.groq_fallback_client = AsyncGroq(api_key=groq_key)
                 except ImportError:
                     pass
             print("Using Google Gemini Flash.")
         elif groq_key:
             try:
-                from groq import Groq
-                self.llm_client = Groq(api_key=groq_key)
+                from groq import AsyncGroq
+                self.llm_client = AsyncGroq(api_key=groq_key)
                 self.llm_provider = "groq"
                 print("Using Groq (Llama-3).")
             except ImportError:
@@ -72,31 +265,180 @@ class HebrewRAGEngine:
         else:
             print("Warning: No LLM API keys found (GOOGLE_API_KEY or GROQ_API_KEY).")
 
-    def chunk_content(self, text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
-        if not text:
-            return []
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunks.append(text[start:end])
-            start += chunk_size - overlap
-        return chunks
-
-    def _add_chunks_to_index(self, chunks: List[str], metas: List[dict]):
-        if chunks:
-            embeddings = self.embedding_model.encode(chunks)
-            self.index.add(np.array(embeddings).astype('float32'))
-            self.metadata_store.extend(metas)
-            print(f"Added {len(chunks)} chunks to index.")
-
-    def add_document(self, pdf_path: str, doc_id: str):
-        print(f"Processing document: {pdf_path}")
-        content_items = self.parser.extract_content(pdf_path)
-        
-        all_chunks = []
-        all_metas = []
+    def _load_embedding_model(self, model_name: str, backend: str) -> SentenceTransformer:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if backend == 'onnx-int8':
+            # int8 ONNX Runtime on CPU; needs sentence-transformers[onnx]
+            try:
+                return SentenceTransformer(
+                    model_name, device='cpu', backend='onnx',
+                    model_kwargs={'file_name': self.ONNX_INT8_FILE},
+                )
+            except Exception as e:
+                print(f"Warning: ONNX backend unavailable ({e}). Falling back to torch.")
+        elif backend != 'torch':
+            raise ValueError(f"Unknown embedding_backend: {backend}")
         
+        model = SentenceTransformer(model_name, device=device)
+        if device == 'cuda':
+            # fp16 halves memory traffic and uses tensor cores
+            model.half()
+        return model
+
+    def _create_index(self):
+        # Vectors are L2-normalized, so inner product == cosine similarity.
+        if self.index_type == 'flat':
+            # Exact scan, cheapest for small corpora
+            return faiss.IndexFlatIP(self.dimension)
+        if self.index_type == 'hnsw':
+            # Graph-based ANN instead of a brute-force scan
+            index = faiss.IndexHNSWFlat(self.dimension, self.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+            self._configure_index(index)
+            return index
+        if self.index_type == 'sq8':
+            # Exact until SQ_TRAIN_SIZE vectors are in, then swapped for the
+            # int8 index by _maybe_quantize (a tiny training set wrecks recall)
+            return faiss.IndexFlatIP(self.dimension)
+        raise ValueError(f"Unknown index_type: {self.index_type}")
+
+    def _maybe_quantize(self):
+        # int8 codes: 4x less memory to scan than float32. Row order is
+        # kept, so metadata ids stay valid. Caller holds _index_lock.
+        if (self.index_type != 'sq8' or not isinstance(self.index, faiss.IndexFlat)
+                or self.index.ntotal < self.SQ_TRAIN_SIZE):
+            return
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        index = faiss.IndexScalarQuantizer(
+            self.dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(vectors[:self.SQ_TRAIN_SIZE])
+        index.add(vectors)
+        self.index = index
+        print(f"Quantized index to 8-bit after {index.ntotal} vectors.")
+
+    def _configure_index(self, index):
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.HNSW_EF_SEARCH
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        # Normalization is fused into encode, so the result is ready for the IP index
+        embeddings = self.embedding_model.encode(
+            texts,
+            batch_size=self.EMBED_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        # FAISS needs C-contiguous float32 and silently copies anything else;
+        # this is a no-op when encode already returned that
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    def _embed_chunks(self, chunks: List[str]) -> np.ndarray:
+        keys = [hashlib.sha256(chunk.encode('utf-8')).digest() for chunk in chunks]
+        # Cached vectors, plus unique uncached texts in first-seen order
+        found, misses = {}, {}
+        with self._emb_lock:
+            for key, chunk in zip(keys, chunks):
+                if key in found or key in misses:
+                    continue
+                if key in self._emb_cache:
+                    self._emb_cache.move_to_end(key)
+                    found[key] = self._emb_cache[key]
+                else:
+                    misses[key] = chunk
+        if misses:
+            found.update(zip(misses.keys(), self._encode(list(misses.values()))))
+            with self._emb_lock:
+                for key in misses:
+                    self._emb_cache[key] = found[key]
+                while len(self._emb_cache) > self.EMB_CACHE_SIZE:
+                    self._emb_cache.popitem(last=False)
+        return np.stack([found[key] for key in keys]).astype(np.float32, copy=False)
+
+    def _clear_query_cache(self):
+        with self._qcache_lock:
+            self._qcache_vecs = np.empty((0, self.dimension), dtype='float32')
+            self._qcache_top_k: List[int] = []
+            self._qcache_resps: List[RAGSearchResponse] = []
+            self.query_cache_generation += 1
+
+    def _lookup_query_cache(self, query_vec: np.ndarray, top_k: int) -> Optional[RAGSearchResponse]:
+        with self._qcache_lock:
+            if not self._qcache_resps:
+                return None
+            sims = self._qcache_vecs @ query_vec[0]
+            # Only entries answered with the same top_k are interchangeable
+            sims[np.asarray(self._qcache_top_k) != top_k] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] < self.QUERY_CACHE_THRESHOLD:
+                return None
+            # Move the hit to the most-recently-used end
+            vec = self._qcache_vecs[best:best + 1]
+            self._qcache_vecs = np.vstack([np.delete(self._qcache_vecs, best, axis=0), vec])
+            self._qcache_top_k.append(self._qcache_top_k.pop(best))
+            response = self._qcache_resps.pop(best)
+            self._qcache_resps.append(response)
+            return response
+
+    def _store_query_cache(self, query_vec: np.ndarray, top_k: int, response: RAGSearchResponse,
+                           generation: int):
+        with self._qcache_lock:
+            # Chunks were added while this answer was generated; it may be stale
+            if generation != self.query_cache_generation:
+                return
+            self._qcache_vecs = np.vstack([self._qcache_vecs, query_vec])[-self.QUERY_CACHE_SIZE:]
+            self._qcache_top_k = (self._qcache_top_k + [top_k])[-self.QUERY_CACHE_SIZE:]
+            self._qcache_resps = (self._qcache_resps + [response])[-self.QUERY_CACHE_SIZE:]
+
+    def _chunk_starts(self, text_len: int, chunk_size: int, overlap: int) -> range:
+        step = chunk_size - overlap
+        if step <= 0:
+            raise ValueError("overlap must be smaller than chunk_size")
+        return range(0, text_len, step)
+
+    def chunk_content(self, text: str, chunk_size: int = 800, overlap: int = 100) -> Iterator[str]:
+        # Lazy, so a large document is never held as a full chunk list.
+        # Arguments are validated eagerly, when called.
+        starts = self._chunk_starts(len(text), chunk_size, overlap)
+        return (text[start:start + chunk_size] for start in starts)
+
+    def _add_chunks_to_index(self, chunks: Iterable[str], metas: Iterable[dict]) -> int:
+        # Embed and add in fixed-size windows so peak memory stays flat
+        # regardless of document size
+        pairs = zip(chunks, metas)
+        total = 0
+        while True:
+            window = list(itertools.islice(pairs, self.INDEX_BATCH_SIZE))
+            if not window:
+                break
+            window_chunks = [chunk for chunk, _ in window]
+            embeddings = self._embed_chunks(window_chunks)
+            with self._index_lock:
+                if self._index_mmapped:
+                    # Copy into RAM before the first write. clone_index would
+                    # keep viewing the mapping, and FAISS aborts on writes to it.
+                    self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+                    self._configure_index(self.index)
+                    self._index_mmapped = False
+                # Metadata first: a failed insert leaves the index untouched,
+                # and a failed add is undone by truncating the rows back
+                size = len(self.metadata_store)
+                self.metadata_store.extend([meta for _, meta in window])
+                try:
+                    self.index.add(embeddings)
+                except Exception:
+                    self.metadata_store.truncate(size)
+                    raise
+                self._maybe_quantize()
+                # Cached answers may miss the new chunks
+                self._clear_query_cache()
+            total += len(window)
+        if total:
+            print(f"Added {total} chunks to index.")
+        return total
+
+    def _document_metas(self, content_items: List[dict], doc_id: str) -> Iterator[dict]:
         for item in content_items:
             content = item['content']
             page_num = item['page']
@@ -108,75 +450,112 @@ class HebrewRAGEngine:
                 chunks = self.chunk_content(content)
             
             for chunk in chunks:
-                all_chunks.append(chunk)
-                all_metas.append({
+                yield {
                     "doc_id": doc_id,
                     "page": page_num,
                     "type": content_type,
                     "text": chunk
-                })
+                }
+
+    def add_document(self, pdf_path: str, doc_id: str):
+        print(f"Processing document: {pdf_path}")
+        content_items = self.parser.extract_content(pdf_path)
+        
+        # Chunks are built lazily and consumed window by window, as in add_text
+        all_metas, chunk_metas = itertools.tee(self._document_metas(content_items, doc_id))
+        all_chunks = (meta["text"] for meta in chunk_metas)
         
-        self._add_chunks_to_index(all_chunks, all_metas)
+        return self._add_chunks_to_index(all_chunks, all_metas)
 
-    def add_text(self, text: str, doc_id: str, metadata: dict = None, chunk_size=800, overlap=100):
+    def _text_meta(self, chunk: str, doc_id: str, metadata: Optional[dict]) -> dict:
+        return {
+            "doc_id": doc_id,
+            "page": 1,
+            "type": "text",
+            "text": chunk,
+            "metadata": metadata or {}
+        }
+
+    def _prepare_text(self, text: str, fix_text: bool) -> str:
         # Even if it's text, we run it through the Hebrew fixer to be safe
         # (Though usually text from API is already logical)
-        fixed_text = self.parser.fix_hebrew_text(text)
-        chunks = self.chunk_content(fixed_text, chunk_size, overlap)
-        
-        all_metas = []
-        for chunk in chunks:
-            all_metas.append({
-                "doc_id": doc_id,
-                "page": 1,
-                "type": "text",
-                "text": chunk,
-                "metadata": metadata or {}
-            })
+        if fix_text:
+            return self.parser.fix_hebrew_text(text)
+        return self.parser.clean_text(text)
+
+    def prepare_chunks(self, text: str, doc_id: str, metadata: dict = None, chunk_size=800, overlap=100,
+                       fix_text=True):
+        """
+        Chunks text once and returns (fixed_text, chunks, metas) for index_chunks,
+        so callers that need the chunk count up front don't chunk twice.
+        Pass fix_text=False for text that is already in logical order.
+        """
+        fixed_text = self._prepare_text(text, fix_text)
+        chunks = list(self.chunk_content(fixed_text, chunk_size, overlap))
+        metas = [self._text_meta(chunk, doc_id, metadata) for chunk in chunks]
+        return fixed_text, chunks, metas
+
+    def index_chunks(self, chunks: Iterable[str], metas: Iterable[dict]) -> int:
+        return self._add_chunks_to_index(chunks, metas)
+
+    def add_text(self, text: str, doc_id: str, metadata: dict = None, chunk_size=800, overlap=100,
+                 fix_text=True):
+        fixed_text = self._prepare_text(text, fix_text)
+        # Chunks and metas are consumed in lockstep, so tee buffers ~1 item
+        chunks, meta_chunks = itertools.tee(self.chunk_content(fixed_text, chunk_size, overlap))
+        all_metas = (self._text_meta(chunk, doc_id, metadata) for chunk in meta_chunks)
             
-        self._add_chunks_to_index(chunks, all_metas)
+        return self._add_chunks_to_index(chunks, all_metas)
 
-    def search(self, query: str, top_k: int = 5) -> RAGSearchResponse:
+    async def search(self, query: str, top_k: int = 5) -> RAGSearchResponse:
+        # Embedding and FAISS are CPU-bound; run them off the event loop
         # 1. Embed Query
-        query_vec = self.embedding_model.encode([query]).astype('float32')
+        query_vec = await asyncio.to_thread(self.embed_query, query)
         
-        # 2. Vector Search
-        distances, indices = self.index.search(query_vec, top_k)
-        
-        sources = []
-        context_parts = []
+        cached = self.cached_response(query_vec, top_k)
+        if cached is not None:
+            return cached
+        generation = self.query_cache_generation
         
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx < len(self.metadata_store):
-                meta = self.metadata_store[idx]
-                chunk = RetrievedChunk(
-                    chunk_id=str(idx),
-                    doc_id=meta['doc_id'],
-                    text=meta['text'],
-                    score=float(dist),
-                    metadata=meta
-                )
-                sources.append(chunk)
-                context_parts.append(f"[מקור: {meta['doc_id']}, עמוד: {meta['page']}]\n{meta['text']}")
+        # 2. Vector Search
+        distances, indices = await asyncio.to_thread(self.search_vectors, query_vec, top_k)
         
         # 3. Generate Answer
-        context_text = "\n\n".join(context_parts)
-        prompt = f"""
-### 🧠 הוראות למערכת ה-RAG
-אתה מומחה לניתוח מסמכים רגולטוריים ומשפטיים. תפקידך לספק תשובה **מקיפה, מדויקת ומובנית** בעברית, המבוססת אך ורק על הקונטקסט המצורף למטה.
+        return await self.generate_response(query, query_vec, top_k, distances[0], indices[0], generation)
 
-### � כללי עבודה מחייבים:
-1.  **היצמדות לקונטקסט**: ענה אך ורק על סמך המידע הניתון. אל תשתמש בידע קודם.
-2.  **מקיפות**: אם המידע מופיע במספר מקומות בקונטקסט, שלב את כולם לתשובה אחת שלמה.
-3.  **מבנה**: השתמש בנקודות (bullet points) או במספור במידה ויש רשימת תנאים או דרישות.
-4.  **חוסר מידע**: אם הקונטקסט אינו מכיל מספיק מידע כדי לענות על השאלה במלואה, ציין זאת במפורש. השב: "המידע אינו מופיע במסמכים שנסרקו".
-5.  **דיוק לשוני**: השתמש בשפה מקצועית ועניינית התואמת את אופי המסמכים (חקיקה, רגולציה).
+    def embed_query(self, query: str) -> np.ndarray:
+        return self._encode([query])
 
-### 📄 ציון מקורות (חובה):
-בסוף התשובה, הוסף פסקה בשם "מקורות:" ופרט את מספרי העמודים והמסמכים עליהם התבססת.
-דוגמה: *מקורות: עמודים 14, 15 (מתוך food_regulation).*
+    def cached_response(self, query_vec: np.ndarray, top_k: int) -> Optional[RAGSearchResponse]:
+        cached = self._lookup_query_cache(query_vec, top_k)
+        if cached is None:
+            return None
+        # Callers may reassign fields (e.g. sources) on the result
+        return cached.model_copy()
 
----
+    def search_vectors(self, query_vecs: np.ndarray, top_k: int):
+        # Accepts a (B, d) batch; one call amortizes the scan over all rows
+        with self._index_lock:
+            return self.index.search(query_vecs, top_k)
+
+    async def generate_response(self, query: str, query_vec: np.ndarray, top_k: int,
+                                distances: np.ndarray, indices: np.ndarray,
+                                # query_cache_generation read before the vector search;
+                                # the answer is only cached if no chunks were added since
+                                cache_generation: int) -> RAGSearchResponse:
+        # FAISS pads missing results with -1; mask them out in one numpy pass
+        valid = (indices >= 0) & (indices < len(self.metadata_store))
+        hits = list(zip(indices[valid].tolist(), distances[valid].tolist()))
+        metas = self.metadata_store.get_many([idx for idx, _ in hits])
+        
+        sources = [
+            RetrievedChunk(chunk_id=str(idx), doc_id=meta['doc_id'], text=meta['text'], score=score, metadata=meta)
+            for (idx, score), meta in zip(hits, metas)
+        ]
+        context_text = "\n\n".join(
+            f"[מקור: {meta['doc_id']}, עמוד: {meta['page']}]\n{meta['text']}" for meta in metas
+        )
+        prompt = f"""
 ### 🔎 CONTEXT (מידע מהמסמכים):
 {context_text}
 
@@ -187,45 +566,191 @@ class HebrewRAGEngine:
 ### ✅ ANSWER (התשובה המקיפה):
 """
         answer = "LLM not configured."
+        cacheable = True
         if self.llm_provider == "google":
             try:
-                response = self.llm_client.generate_content(prompt)
+                response = await self.llm_client.generate_content_async(prompt)
                 answer = response.text
             except Exception as e:
                 print(f"Gemini error: {e}")
                 if self.groq_fallback_client:
                     print("Falling back to Groq...")
-                    chat_completion = self.groq_fallback_client.chat.completions.create(
-                        messages=[{"role": "user", "content": prompt}],
+                    chat_completion = await self.groq_fallback_client.chat.completions.create(
+                        messages=[
+                            {"role": "system", "content": SYSTEM_PROMPT},
+                            {"role": "user", "content": prompt},
+                        ],
                         model="llama-3.3-70b-versatile",
                     )
                     answer = chat_completion.choices[0].message.content
                 else:
                     answer = f"Gemini error and no fallback: {e}"
+                    cacheable = False
         elif self.llm_provider == "groq":
-            chat_completion = self.llm_client.chat.completions.create(
-                messages=[{"role": "user", "content": prompt}],
+            chat_completion = await self.llm_client.chat.completions.create(
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
                 model="llama-3.3-70b-versatile",
             )
             answer = chat_completion.choices[0].message.content
             
-        return RAGSearchResponse(answer=answer, sources=sources)
+        result = RAGSearchResponse(answer=answer, sources=sources)
+        if cacheable:
+            self._store_query_cache(query_vec, top_k, result, cache_generation)
+            return result.model_copy()
+        return result
+
+    def _read_index(self, index_path: str, mmap: bool):
+        self._index_mmapped = False
+        if mmap:
+            # Let the OS page in only the vectors a search touches
+            try:
+                # MMAP_IFC maps the stored codes in place; plain IO_FLAG_MMAP
+                # still reads flat/HNSW/SQ indexes into heap memory
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC)
+                self._index_mmapped = True
+                return index
+            except RuntimeError as e:
+                print(f"Warning: could not mmap index ({e}). Loading into memory.")
+        return faiss.read_index(index_path)
 
     def save_index(self, path="faiss_index"):
-        faiss.write_index(self.index, f"{path}.index")
-        with open(f"{path}_meta.pkl", "wb") as f:
-            pickle.dump(self.metadata_store, f)
+        # Metadata first: if we stop between the two swaps, load_index sees
+        # extra rows, which it can ignore, rather than vectors with no rows
+        self.metadata_store.save(f"{path}_meta.db")
+        self._write_index(f"{path}.index")
 
-    def load_index(self, path="faiss_index"):
+    def _write_index(self, index_path: str):
+        # Write to a temp file and swap it in: overwriting a file that is
+        # still mapped (ours or another process's) crashes with SIGBUS
+        faiss.write_index(self.index, f"{index_path}.tmp")
+        os.replace(f"{index_path}.tmp", index_path)
+
+    def _check_metadata_size(self, path: str):
+        # Both files are swapped in by save_index, but a crash between the two
+        # swaps can leave extra rows. Only the private copy is trimmed; the
+        # saved file may be in use by another process.
+        rows, vectors = len(self.metadata_store), self.index.ntotal
+        if rows > vectors:
+            print(f"Warning: ignoring {rows - vectors} metadata rows in {path}_meta.db with no vectors in {path}.index.")
+            self.metadata_store.truncate(vectors)
+        elif rows < vectors:
+            raise ValueError(
+                f"{path}_meta.db has {rows} rows but {path}.index has {vectors} vectors. "
+                "Re-run setup_rag.py to rebuild the index."
+            )
+
+    def _convert_l2_index(self) -> bool:
+        # Older builds stored unnormalized vectors in an IndexFlatL2. A flat
+        # index keeps the raw vectors, so rebuild it as cosine exactly.
+        if not isinstance(self.index, faiss.IndexFlat):
+            print("Warning: index was built with L2 distance; scores are not cosine similarities. "
+                  "Re-run setup_rag.py to rebuild it.")
+            return False
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        faiss.normalize_L2(vectors)
+        self.index = faiss.IndexFlatIP(self.dimension)
+        self.index.add(vectors)
+        self._index_mmapped = False
+        print(f"Converted L2 index to cosine ({self.index.ntotal} vectors).")
+        return True
+
+    def load_index(self, path="faiss_index", mmap=True):
         if os.path.exists(f"{path}.index"):
-            self.index = faiss.read_index(f"{path}.index")
-            with open(f"{path}_meta.pkl", "rb") as f:
-                self.metadata_store = pickle.load(f)
+            self.index = self._read_index(f"{path}.index", mmap)
+            self._configure_index(self.index)
+            if self.index.metric_type != faiss.METRIC_INNER_PRODUCT and self._convert_l2_index():
+                # Write the conversion back once, so later loads can mmap the
+                # file instead of rebuilding it in heap on every start
+                try:
+                    self._write_index(f"{path}.index")
+                    self.index = self._read_index(f"{path}.index", mmap)
+                except (OSError, RuntimeError) as e:
+                    print(f"Warning: could not save the converted index ({e}).")
+            if os.path.exists(f"{path}_meta.db"):
+                self.metadata_store = MetaStore.load(f"{path}_meta.db")
+            else:
+                print(f"Migrating {path}_meta.pkl to {path}_meta.db...")
+                self.metadata_store = MetaStore.from_legacy_pickle(f"{path}_meta.pkl", f"{path}_meta.db")
+            self._check_metadata_size(path)
+            self._clear_query_cache()
             print("Index loaded.")
 
+# --- Query Micro-Batching ---
+
+class QueryBatcher:
+    """
+    Coalesces concurrent searches into one batched FAISS call. Queries are
+    drained from a queue for up to max_wait seconds (or max_batch_size
+    queries), searched as a single (B, d) matrix, and each caller gets its
+    own row back. Must be started from a running event loop.
+    """
+    def __init__(self, engine: HebrewRAGEngine, max_batch_size: int = 32, max_wait: float = 0.005):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
+
+    async def search(self, query: str, top_k: int = 5) -> RAGSearchResponse:
+        query_vec = await asyncio.to_thread(self.engine.embed_query, query)
+        cached = self.engine.cached_response(query_vec, top_k)
+        if cached is not None:
+            return cached
+        generation = self.engine.query_cache_generation
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query_vec, top_k, future))
+        distances, indices = await future
+        return await self.engine.generate_response(query, query_vec, top_k, distances, indices, generation)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Search once with the largest top_k; results are sorted, so
+            # each caller just truncates its row
+            query_vecs = np.vstack([vec for vec, _, _ in batch])
+            max_k = max(top_k for _, top_k, _ in batch)
+            try:
+                distances, indices = await asyncio.to_thread(self.engine.search_vectors, query_vecs, max_k)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for row, (_, top_k, future) in enumerate(batch):
+                # The caller may have been cancelled (client disconnect)
+                if not future.done():
+                    future.set_result((distances[row, :top_k], indices[row, :top_k]))
+
 if __name__ == "__main__":
     # Quick functional test
     engine = HebrewRAGEngine()
     # engine.add_document("1169_2011_food_information_HE.pdf", "food_reg")
-    # res = engine.search("מהן הדרישות לסימון אלרגנים?")
+    # res = asyncio.run(engine.search("מהן הדרישות לסימון אלרגנים?"))
     # print(res.answer)